@@ -9,6 +9,8 @@ class LibretroCheat:
     """
     Simple dataclass for strongly typed attribute names
     """
+    __slots__ = ("desc", "code")
+
     desc: str
     code: str
 
@@ -28,7 +30,8 @@ def convert_file(in_file_path: Path, out_dir_path: Path):
             if len(line.strip()) == 0:
                 continue
 
-            key, val = line[:line.find("=")].strip(), line[line.find("=") + 1:].strip()
+            key, _, val = line.partition("=")
+            key, val = key.strip(), val.strip()
             if key == "cheats":
                 expected_num_cheats = int(val)
                 continue
@@ -37,7 +40,7 @@ def convert_file(in_file_path: Path, out_dir_path: Path):
                 continue
             val = val[1:-1]
 
-            key_name, key_type = key.split("_")
+            key_name, _, key_type = key.partition("_")
             if key_name not in cheats_records:
                 cheats_records[key_name] = {}
             cheats_records[key_name][key_type] = val
@@ -61,12 +64,22 @@ def convert(in_tsv: Path, out_dir:Path):
     with open(in_tsv, "r") as in_file:
         lines = in_file.readlines()
         lines = lines[2:]
-        for entry in csv.DictReader(lines, dialect="excel-tab"):
-            game = entry["Game"]
+        reader = csv.reader(lines, dialect="excel-tab")
+        header = next(reader, None)
+        if header is None:
+            return
+        game_idx, effect_idx, keys_idx = header.index("Game"), header.index("Effect…"), header.index("Key in…")
+        game_dirs = set()
+        for entry in reader:
+            if not entry:
+                continue
+            game = entry[game_idx]
             game_dir = out_dir / game
-            game_dir.mkdir(exist_ok=True)
-            cheat_path = game_dir / (entry["Effect…"].strip().replace(" ", "_").replace("/", "_") + ".txt")
-            cheats = [code.strip() for code in entry["Key in…"].split("+")]
+            if game_dir not in game_dirs:
+                game_dir.mkdir(exist_ok=True)
+                game_dirs.add(game_dir)
+            cheat_path = game_dir / (entry[effect_idx].strip().replace(" ", "_").replace("/", "_") + ".txt")
+            cheats = [code.strip() for code in entry[keys_idx].split("+")]
             with open(cheat_path, "w") as out_file:
                 out_file.write("\n".join(cheats) + "\n")
 
@@ -51,16 +51,33 @@ __version__ = "0.1.0"
 
 
 import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
 import logging
+import os
 from pathlib import Path
-from typing import List
+import re
+from typing import Iterator, List, Optional, Set, Tuple
 import xml.etree.ElementTree as ElementTree
 
 
 GAME2ID_MAP_FILENAME = "GameID2cht.bin"
 ENGLISH_CHEATS_DIRNAME = "Eng"
 LIBRETRO_GBA_CHEATS_DIRNAME = "cht/Nintendo - Game Boy Advance"
+IO_BUFFER_SIZE = 1 << 20
+
+# Deletes upper-case hex digits, so any characters left over are not hex
+HEX_DIGITS_DELETION_TABLE = str.maketrans("", "", "0123456789ABCDEF")
+
+# Libretro cheat files are a flat list of `key = value` lines, where the only
+# entries of interest are the cheat count and each `cheatN_desc`/`cheatN_code`.
+LIBRETRO_NUM_CHEATS_PATTERN = re.compile(rb'^\s*cheats\s*=\s*(\d+)', re.MULTILINE)
+LIBRETRO_CHEAT_ENTRY_PATTERN = re.compile(rb'^\s*cheat(\d+)_(desc|code)\s*=\s*"(.*)"[ \t]*\r?$', re.MULTILINE)
+
+# Matches runs of anything other than letters and digits, in any script
+NON_ALNUM_PATTERN = re.compile(r"[\W_]+")
 
 
 @dataclass
@@ -68,6 +85,8 @@ class LibretroCheat:
     """
     Simple dataclass for strongly typed attribute names
     """
+    __slots__ = ("desc", "code")
+
     desc: str
     code: str
 
@@ -91,32 +110,22 @@ class LibretroCheatUnsupportedError(RuntimeError):
     pass
 
 
-def parse_libretro_cheats_from_file(libretro_cheat_path: Path) -> List[LibretroCheat]:
+def parse_libretro_cheats_from_file(libretro_cheat_path: Path) -> Iterator[LibretroCheat]:
     """
-    Reads a libretro cheat file and encodes all cheats within as `LibretroCheat`
-    objects.  This function is not responsible for parsing or converting the
-    cheat codes themselves.
+    Reads a libretro cheat file and yields all cheats within as `LibretroCheat`
+    objects, in file order.  This function is not responsible for parsing or
+    converting the cheat codes themselves.
     """
-    expected_num_cheats = None
-    cheats_records = {}
-    with open(libretro_cheat_path, "r") as libretro_cheat_file:
-        for line in libretro_cheat_file:
-            if len(line.strip()) == 0:
-                continue
-
-            key, val = line[:line.find("=")].strip(), line[line.find("=") + 1:].strip()
-            if key == "cheats":
-                expected_num_cheats = int(val)
-                continue
-            elif key == "cheat_enable":
-                # Malformed cheat file handling, should be cheatN_enable
-                continue
-            val = val[1:-1]
-
-            key_name, key_type = key.split("_")
-            if key_name not in cheats_records:
-                cheats_records[key_name] = {}
-            cheats_records[key_name][key_type] = val
+    with open(libretro_cheat_path, "rb") as libretro_cheat_file:
+        data = libretro_cheat_file.read()
+
+    num_cheats_match = LIBRETRO_NUM_CHEATS_PATTERN.search(data)
+    expected_num_cheats = int(num_cheats_match.group(1)) if num_cheats_match else None
+
+    # Keyed by numeric cheat index so that cheats sort in file order
+    cheats_records = defaultdict(dict)
+    for cheat_index, key_type, val in LIBRETRO_CHEAT_ENTRY_PATTERN.findall(data):
+        cheats_records[int(cheat_index)][key_type] = val.decode("utf-8")
 
     if len(cheats_records) != expected_num_cheats:
         raise LibretroParseError(
@@ -124,10 +133,56 @@ def parse_libretro_cheats_from_file(libretro_cheat_path: Path) -> List[LibretroC
             f"Got {len(cheats_records)}, expected {expected_num_cheats}"
         )
 
-    return [
-        LibretroCheat(cheats_records[key]["desc"], cheats_records[key]["code"])
-        for key in sorted(cheats_records.keys())
-    ]
+    for key in sorted(cheats_records):
+        yield LibretroCheat(cheats_records[key][b"desc"], cheats_records[key][b"code"])
+
+
+def _convert_code_breaker_8bit_write(addr_tok: str, value_tok: str) -> str:
+    return f"4{addr_tok[-4:]},{value_tok[-2:]}"
+
+
+def _convert_code_breaker_16bit_write(addr_tok: str, value_tok: str) -> str:
+    return f"4{addr_tok[-4:]},{value_tok[2:]},{value_tok[:2]}"
+
+
+def _reject_unsupported_code_breaker_type(addr_tok: str, value_tok: str) -> str:
+    raise LibretroCheatUnsupportedError(f"Code Breaker cheat type {addr_tok[0]} is not supported")
+
+
+# Conversions for each Code Breaker code type, indexed by the ordinal of the
+# leading character of the address token, as described here
+# https://www.sappharad.com/gba/codes/codebreaker-code-creation
+# See https://github.com/ez-flash/omega-de-kernel/blob/fb9d871d8df267cc9f322d41b7ee609552329c56/source/GBApatch.c#L473
+# for handling fo the leading "4" in the target address.  Unknown types are `None`.
+CODE_BREAKER_DISPATCH = [None] * 256
+CODE_BREAKER_DISPATCH[ord("3")] = _convert_code_breaker_8bit_write
+CODE_BREAKER_DISPATCH[ord("8")] = _convert_code_breaker_16bit_write
+for _code_type in "467AD":
+    CODE_BREAKER_DISPATCH[ord(_code_type)] = _reject_unsupported_code_breaker_type
+del _code_type
+
+
+def convert_code_breaker_directive(addr_tok: str, value_tok: str) -> str:
+    """
+    Converts a single Code Breaker address/value pair to an EZ-Flash Omega
+    directive.
+    @throws LibretroParseError if the input is malformed
+    @throws LibretroCheatUnsupportedError if the input code is unsupported
+    """
+    if len(addr_tok) != 8:
+        raise LibretroParseError(
+            f"Expected cheat target address of len 8, got len {len(addr_tok)} for address {addr_tok}"
+        )
+
+    if value_tok.translate(HEX_DIGITS_DELETION_TABLE):
+        raise LibretroCheatUnsupportedError(f"Value is not hexadecimal ({value_tok})")
+
+    code_type = ord(addr_tok[0])
+    converter = CODE_BREAKER_DISPATCH[code_type] if code_type < len(CODE_BREAKER_DISPATCH) else None
+    if converter is None:
+        raise LibretroParseError(f"Unknown Code Breaker cheat code type of '{addr_tok[0]}'")
+
+    return converter(addr_tok, value_tok)
 
 
 def convert_libretro_cheat_to_ezflash(libretro_cheat: LibretroCheat) -> str:
@@ -140,49 +195,31 @@ def convert_libretro_cheat_to_ezflash(libretro_cheat: LibretroCheat) -> str:
     result = f"[{libretro_cheat.desc}(LRDB)]\nON="
 
     toks = libretro_cheat.code.split("+")
-    cheat_directives = []
-    for i in range(0, len(toks), 2):
-        # Catch malformed cheat codes
-        try:
-            addr_tok = toks[i]
-            value_tok = toks[i + 1]
-        except IndexError:
-            raise LibretroParseError("Unexpected number of tokens in Libretro cheat")
-
-        if len(addr_tok) != 8:
-            raise LibretroParseError(
-                f"Expected cheat target address of len 8, got len {len(addr_tok)} for address {addr_tok}"
-            )
-
-        if not all(c in "0123456789ABCDEF" for c in value_tok):
-            raise LibretroCheatUnsupportedError(f"Value is not hexadecimal ({value_tok})")
-
-        # Switch based on the Code Breaker code type, as described here
-        # https://www.sappharad.com/gba/codes/codebreaker-code-creation
-        # See https://github.com/ez-flash/omega-de-kernel/blob/fb9d871d8df267cc9f322d41b7ee609552329c56/source/GBApatch.c#L473
-        # for handling fo the leading "4" in the target address
-        if addr_tok[0] == "3":
-            cheat_directives.append(f"4{addr_tok[-4:]},{value_tok[-2:]}")
-        elif addr_tok[0] == "8":
-            cheat_directives.append(f"4{addr_tok[-4:]},{value_tok[2:]},{value_tok[:2]}")
-        elif addr_tok[0] in ["4", "6", "7", "A", "D"]:
-            raise LibretroCheatUnsupportedError(f"Code Breaker cheat type {addr_tok[0]} is not supported")
-        else:
-            raise LibretroParseError(f"Unknown Code Breaker cheat code type of '{addr_tok[0]}'")
+    # Catch malformed cheat codes
+    if len(toks) % 2:
+        raise LibretroParseError("Unexpected number of tokens in Libretro cheat")
 
+    cheat_directives = [
+        convert_code_breaker_directive(addr_tok, value_tok)
+        for addr_tok, value_tok in zip(toks[0::2], toks[1::2])
+    ]
     result += ";".join(cheat_directives)
 
     return result
 
 
-def create_stub_ezflash_cht_file(destination: Path):
+def create_stub_ezflash_cht_file(destination: Path, known_dirs: Optional[Set[Path]] = None):
     """
     This may not be sufficient, but all this does for now is touch the destination
     file.  A parent directory is created if necessary beceause the EZ-Flash official
     database does not have a directory for roms with numeric ID >2800, but the
-    libretro cheat database has cheats for roms with IDs in that range.
+    libretro cheat database has cheats for roms with IDs in that range.  If given,
+    `known_dirs` tracks directories already created so they aren't created again.
     """
-    destination.parent.mkdir(exist_ok=True)
+    if known_dirs is None or destination.parent not in known_dirs:
+        destination.parent.mkdir(exist_ok=True)
+        if known_dirs is not None:
+            known_dirs.add(destination.parent)
     destination.touch()
 
 
@@ -192,75 +229,149 @@ def patch_ezflash_cht_file(ezflash_cht_path: Path, libretro_cht_path: Path):
     cheats.  Any cheat codes that are not parsed successfully or are not supported
     are skipped with a warning.
     """
-    libretro_cheats = parse_libretro_cheats_from_file(libretro_cht_path)
     ezflash_cheats = []
-    for libretro_cheat in libretro_cheats:
+    for libretro_cheat in parse_libretro_cheats_from_file(libretro_cht_path):
         try: 
             ezflash_cheats.append(convert_libretro_cheat_to_ezflash(libretro_cheat))
         except (LibretroCheatUnsupportedError, LibretroParseError) as err:
             logging.warning(f"Skipping libretro cheat...{err}")
     
-    with open(ezflash_cht_path, "rb") as cht_file:
+    # Prepend the new cheats in place through a single read/write handle
+    payload = b"\n\n".join(cheat.encode("utf-8") for cheat in ezflash_cheats) + b"\n\n"
+    with open(ezflash_cht_path, "r+b", buffering=IO_BUFFER_SIZE) as cht_file:
         original_cht_file_contents = cht_file.read()
+        cht_file.seek(0)
+        cht_file.write(payload)
+        cht_file.write(original_cht_file_contents)
+        cht_file.truncate()
 
-    with open(ezflash_cht_path, "wb") as cht_file_writable:
-        cht_file_writable.write("\n\n".join(ezflash_cheats).encode("utf-8"))
-        cht_file_writable.write(b"\n\n")
-        cht_file_writable.write(original_cht_file_contents)
-    
     logging.info(f"Patched {str(ezflash_cht_path)} successfully, added {len(ezflash_cheats)} cheats")
 
 
+def _init_worker_logging(level: int):
+    """
+    Process pool initializer.  Workers started with the `spawn` method don't
+    inherit the logging configuration from `main()`, so apply the same level.
+    """
+    logging.basicConfig(level=level)
+
+
+def _patch_ezflash_cht_file_job(job: Tuple[Path, List[Path]]):
+    """
+    Applies every libretro cheat file queued for a single EZ-Flash cht file.
+    Module-level so that it can be pickled for a process pool.
+    """
+    ezflash_cht_path, libretro_cht_paths = job
+    for libretro_cht_path in libretro_cht_paths:
+        patch_ezflash_cht_file(ezflash_cht_path, libretro_cht_path)
+
+
+@lru_cache(maxsize=8192)
+def _stem(name: str) -> str:
+    """
+    Reduces a ROM or cheat file name to the bare game title used to correlate
+    DAT entries with libretro cheat files.  The extension is dropped, and the
+    title is cut at the first region/revision tag.
+    """
+    base = name.rsplit(".", 1)[0]
+    return base.partition("(")[0].strip()
+
+
+@lru_cache(maxsize=8192)
+def _normalize(game_name: str) -> str:
+    """
+    Lower-cases a game name and drops punctuation and whitespace, so that
+    names differing only in those respects between the DAT file and the
+    libretro database still correlate.  Notably libretro substitutes `_` for
+    `&` in file names, and both are dropped here.
+    """
+    return NON_ALNUM_PATTERN.sub("", game_name.lower())
+
+
 def patch(ezflash_cheats_dir: Path, datfile_path: Path, libretro_database_dir: Path):
     """
     """
     game2id_map_path = ezflash_cheats_dir / GAME2ID_MAP_FILENAME
+    english_cheats_dir = ezflash_cheats_dir / ENGLISH_CHEATS_DIRNAME
 
-    # We need fast, repeated lookups into the DAT database, so parse into memory
-    parsed_dat_tree = ElementTree.parse(datfile_path)
+    # We need fast, repeated lookups into the DAT database, so stream the file
+    # into a dict, discarding each element once it's been read.
     serial_code_to_name = {}
-    for rom in parsed_dat_tree.findall(".//rom"):
-        try:
-            rom_name = rom.attrib["name"]
-            rom_serial_code = rom.attrib["serial"]
-            serial_code_to_name[rom_serial_code] = rom_name[:rom_name.rfind(".")][:rom_name.find("(")].strip()
-        except KeyError:
-            # Assume this is BIOS entry
-            logging.warning(f"Skipping ROM without `serial` field, this should be a BIOS file (name: {rom_name})")
-            pass
+    root = None
+    for event, elem in ElementTree.iterparse(datfile_path, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+        elif elem.tag == "rom":
+            try:
+                rom_name = elem.attrib["name"]
+                rom_serial_code = elem.attrib["serial"]
+                serial_code_to_name[rom_serial_code] = _stem(rom_name)
+            except KeyError:
+                # Assume this is BIOS entry
+                logging.warning(f"Skipping ROM without `serial` field, this should be a BIOS file (name: {rom_name})")
+                pass
+            elem.clear()
+        elif elem.tag == "game":
+            # Drop processed games from the root so memory use stays constant
+            root.clear()
 
     libretro_cheat_dir = libretro_database_dir / LIBRETRO_GBA_CHEATS_DIRNAME
-    libretro_game_name_to_cheat_path = {}
+    libretro_game_key_to_cheat_path = {}
     for path in libretro_cheat_dir.iterdir():
-        game_name = path.name[:path.name.rfind(".")][:path.name.find("(")].strip()
-        libretro_game_name_to_cheat_path[game_name] = path
-
-    with open(game2id_map_path, "r") as game2id_map_file:
-        # Each DB entry is 8 characters long, first 4 chars is the serial code,
-        # last 4 chars is the numeric ID.
-        while game2id_entry := game2id_map_file.read(8):
-            game_serial_code = game2id_entry[:4]
-            game_numeric_id = int(game2id_entry[4:])
-
-            try:
-                game_name = serial_code_to_name[game_serial_code]
-            except KeyError:
-                logging.warning(f"Could not find game with serial code {game_serial_code}")
-                continue
-            libretro_cheat_file_path = libretro_game_name_to_cheat_path.get(game_name)
-            if libretro_cheat_file_path is None:
-                logging.warning(f"No libretro cheats for game name {game_name}, serial {game_serial_code}, numeric ID {str(game_numeric_id).zfill(4)}")
-                continue
-
-            cheat_file_numbered_subdir = Path(str(game_numeric_id - (game_numeric_id % 200)).zfill(4))
-            target_cheat_file_path = (
-                ezflash_cheats_dir / ENGLISH_CHEATS_DIRNAME / cheat_file_numbered_subdir / f"{str(game_numeric_id).zfill(4)}.cht"
+        game_key = _normalize(_stem(path.name))
+        if game_key in libretro_game_key_to_cheat_path:
+            logging.warning(
+                f"Libretro cheat files {libretro_game_key_to_cheat_path[game_key].name} and {path.name} "
+                f"have the same normalized game name, using {path.name}"
             )
+        libretro_game_key_to_cheat_path[game_key] = path
+
+    with open(game2id_map_path, "rb") as game2id_map_file:
+        game2id_map = game2id_map_file.read()
+
+    # Enumerate existing cht files and subdirectories in one walk rather than
+    # stat-ing each target
+    existing_cheat_file_paths = set()
+    known_cheat_subdirs = set()
+    for dir_path, _, file_names in os.walk(english_cheats_dir):
+        dir_path = Path(dir_path)
+        known_cheat_subdirs.add(dir_path)
+        existing_cheat_file_paths.update(
+            dir_path / file_name for file_name in file_names if file_name.endswith(".cht")
+        )
 
-            if not target_cheat_file_path.exists():
-                create_stub_ezflash_cht_file(target_cheat_file_path)
+    patch_jobs = {}
+    # Each DB entry is 8 characters long, first 4 chars is the serial code,
+    # last 4 chars is the numeric ID.
+    for entry_offset in range(0, len(game2id_map), 8):
+        game_serial_code = game2id_map[entry_offset:entry_offset + 4].decode("ascii")
+        game_numeric_id = int(game2id_map[entry_offset + 4:entry_offset + 8])
 
-            patch_ezflash_cht_file(target_cheat_file_path, libretro_cheat_file_path)
+        try:
+            game_name = serial_code_to_name[game_serial_code]
+        except KeyError:
+            logging.warning(f"Could not find game with serial code {game_serial_code}")
+            continue
+        libretro_cheat_file_path = libretro_game_key_to_cheat_path.get(_normalize(game_name))
+        if libretro_cheat_file_path is None:
+            logging.warning(f"No libretro cheats for game name {game_name}, serial {game_serial_code}, numeric ID {game_numeric_id:04d}")
+            continue
+
+        cheat_file_numbered_subdir = f"{game_numeric_id - (game_numeric_id % 200):04d}"
+        target_cheat_file_path = english_cheats_dir / cheat_file_numbered_subdir / f"{game_numeric_id:04d}.cht"
+
+        if target_cheat_file_path not in existing_cheat_file_paths:
+            create_stub_ezflash_cht_file(target_cheat_file_path, known_cheat_subdirs)
+            existing_cheat_file_paths.add(target_cheat_file_path)
+
+        patch_jobs.setdefault(target_cheat_file_path, []).append(libretro_cheat_file_path)
+
+    # Each EZ-Flash cht file is patched independently, so fan the work out
+    # across processes.  Patches targeting the same file stay in one job so
+    # they're applied in order and never race on the same file.
+    with ProcessPoolExecutor(initializer=_init_worker_logging, initargs=(logging.getLogger().level,)) as executor:
+        list(executor.map(_patch_ezflash_cht_file_job, patch_jobs.items(), chunksize=16))
 
 
 def main_patch(args: argparse.Namespace):